@@ -0,0 +1,141 @@
+#!/usr/bin/env python
+#
+# Compares the memory and time needed to hold Livestatus rows as plain dicts
+# and as HostStatus records, and the time needed to diff the packages of the
+# whole fleet at once or host by host.
+#
+
+import sys
+import random
+import timeit
+import resource
+import subprocess
+
+from nagios2mantis_security import HostStatus
+from nagios2mantis_security import FleetPackages
+
+ROWS = 50000
+PROFILES = 50
+
+
+def make_rows(count):
+    return [
+        {
+            'host_name': 'host%d' % i,
+            'plugin_output': 'Packages: python-django python-soappy',
+            'host_notes': '',
+        }
+        for i in range(count)
+    ]
+
+
+def row_size(row):
+    # Only the containers are compared: both models reference strings of
+    # the same sizes (the columns and one parsed package string per row)
+    return sys.getsizeof(row)
+
+
+def load_dicts():
+    rows = make_rows(ROWS)
+    for row in rows:
+        row['packages'] = row['plugin_output'].split(': ')[1]
+        row['all_packages'] = row['packages']
+    return rows
+
+
+def load_statuses():
+    # Same path as SecurityUpdatesChecker._nagios_call
+    statuses = HostStatus.from_rows(make_rows(ROWS))
+    for status in statuses:
+        status['all_packages'] = status['packages']
+    return statuses
+
+
+MODELS = (('dict', load_dicts), ('HostStatus', load_statuses))
+
+
+def peak_memory(name):
+    # ru_maxrss never goes down, so each model is loaded in its own process.
+    # It is in kilobytes on Linux.
+    before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    rows = dict(MODELS)[name]()
+    after = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    print(after - before)
+    return rows
+
+
+def bench_peak_memory():
+    for name, _ in MODELS:
+        peak = int(subprocess.check_output(
+            [sys.executable, __file__, 'peak-memory', name]))
+        print('%-11s %.1f MB peak while loading %d rows' % (
+            name + ':', peak / 1024.0, ROWS))
+
+
+def main():
+    # Forked processes start from the parent's ru_maxrss, so peak memory is
+    # measured before this process loads anything
+    bench_peak_memory()
+
+    rows = load_dicts()
+    statuses = load_statuses()
+
+    dict_size = sum(row_size(row) for row in rows)
+    slots_size = sum(row_size(status) for status in statuses)
+    print('dict:       %d bytes per row' % (dict_size // ROWS))
+    print('HostStatus: %d bytes per row' % (slots_size // ROWS))
+    print('saved:      %d bytes per row, %.1f MB for %d rows' % (
+        (dict_size - slots_size) // ROWS,
+        (dict_size - slots_size) / 1024.0 / 1024.0,
+        ROWS,
+    ))
+
+    timer = timeit.Timer(lambda: [HostStatus.from_row(row) for row in rows])
+    print('HostStatus.from_row: %.3fs for %d rows' % (
+        min(timer.repeat(3, 1)), ROWS))
+
+    bench_fleet()
+
+
+def make_fleet(count):
+    # Hosts installed from the same few profiles share their package lists
+    random.seed(0)
+    vocabulary = ['package%d' % i for i in range(2000)]
+    profiles = []
+    for i in range(PROFILES):
+        packages = random.sample(vocabulary, 30)
+        profiles.append((' '.join(packages), frozenset(packages[:25])))
+    current = {}
+    notified = {}
+    for i in range(count):
+        packages, notified_packages = profiles[i % PROFILES]
+        current['host%d' % i] = packages
+        notified['host%d' % i] = notified_packages
+    return current, notified
+
+
+def per_host_diff(current, notified):
+    diffs = {}
+    for hostname, packages in current.items():
+        notified_packages = notified[hostname]
+        diffs[hostname] = [package for package in packages.split(' ')
+                           if package not in notified_packages]
+    return diffs
+
+
+def bench_fleet():
+    current, notified = make_fleet(ROWS)
+    loop = min(timeit.Timer(
+        lambda: per_host_diff(current, notified)).repeat(3, 1))
+    fleet = min(timeit.Timer(
+        lambda: FleetPackages(current, notified)).repeat(3, 1))
+    print('per host package diff: %.3fs for %d hosts' % (loop, ROWS))
+    print('FleetPackages:         %.3fs for %d hosts, with package counts' % (
+        fleet, ROWS))
+
+
+if __name__ == '__main__':
+    if sys.argv[1:2] == ['peak-memory']:
+        peak_memory(sys.argv[2])
+    else:
+        main()
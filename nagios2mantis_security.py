@@ -17,15 +17,19 @@
 
 import socket
 import sys
+import time
+import random
+import hashlib
 import logging
 import argparse
 import sqlite3
-import yaml
-from SOAPpy import WSDL
-from SOAPpy import faultType
-from mk_livestatus import Socket
+import collections
+import functools
 from ConfigParser import RawConfigParser
-from parse import parse
+
+# SOAPpy, yaml, parse and mk_livestatus are imported where they are first
+# needed: most runs stop after comparing the Nagios digest with the previous
+# one and never talk to Mantis.
 
 
 class Config(RawConfigParser):
@@ -35,6 +39,10 @@ class Config(RawConfigParser):
 
         self.nagios_host = self.get('Nagios', 'host')
         self.nagios_port = int(self.get('Nagios', 'port'))
+        self.nagios_full_sweep_interval = int(
+            self.get_default('Nagios', 'full_sweep_interval', 0))
+        self.nagios_clock_skew_margin = int(
+            self.get_default('Nagios', 'clock_skew_margin', 300))
 
         self.mantis_wsdl = self.get('Mantis', 'wsdl')
         self.mantis_username = self.get('Mantis', 'username')
@@ -42,6 +50,13 @@ class Config(RawConfigParser):
         self.mantis_category = self.get('Mantis', 'category')
         self.mantis_project_id = int(self.get('Mantis', 'default_project_id'))
         self.mantis_status_id = int(self.get('Mantis', 'resolved_status_id'))
+        timeout = self.get_default('Mantis', 'timeout', None)
+        self.mantis_timeout = float(timeout) if timeout else None
+        self.mantis_retries = int(self.get_default('Mantis', 'retries', 0))
+        self.mantis_retry_backoff = float(
+            self.get_default('Mantis', 'retry_backoff', 1))
+        self.mantis_circuit_threshold = int(
+            self.get_default('Mantis', 'circuit_breaker_threshold', 0))
 
         self.template_summary = self.get('Templates', 'summary')
         self.template_description = self.get('Templates', 'description')
@@ -50,6 +65,234 @@ class Config(RawConfigParser):
 
         self.sqlite_filename = self.get('DB', 'sqlite_filename')
 
+    def get_default(self, section, option, default):
+        if self.has_option(section, option):
+            return self.get(section, option)
+        return default
+
+
+class MantisUnavailable(Exception):
+    pass
+
+
+class HostStatus(object):
+    # One Livestatus row. Templates and logging use it like the dict it
+    # replaces, but it has no per-instance __dict__ and the package list is
+    # only parsed from plugin_output once, when first needed.
+    columns = ('host_name', 'plugin_output', 'host_notes')
+    derived = ('packages', 'all_packages')
+    __slots__ = columns + ('_packages', '_parsed_packages', '_all_packages')
+
+    def __init__(self, host_name, plugin_output, host_notes=''):
+        self.host_name = host_name
+        self.plugin_output = plugin_output
+        self.host_notes = host_notes
+
+    @classmethod
+    def from_row(cls, row):
+        if isinstance(row, cls):
+            return row
+        status = cls(*[row.get(column, '') for column in cls.columns])
+        for key in cls.derived:
+            if key in row:
+                status[key] = row[key]
+        return status
+
+    @classmethod
+    def from_rows(cls, rows):
+        # Rows are replaced in place so that each dict can be freed as soon
+        # as it is converted, instead of keeping both lists alive
+        for index, row in enumerate(rows):
+            rows[index] = cls.from_row(row)
+        return rows
+
+    @property
+    def packages(self):
+        # Only an explicitly set value is part of the row's keys, so parsing
+        # does not change how the row compares or is logged
+        try:
+            return self._packages
+        except AttributeError:
+            pass
+        try:
+            return self._parsed_packages
+        except AttributeError:
+            # Outputs such as "Service check timed out" list no packages
+            output = self.plugin_output.split(': ')
+            self._parsed_packages = output[1] if len(output) > 1 else None
+            return self._parsed_packages
+
+    @packages.setter
+    def packages(self, value):
+        self._packages = value
+
+    @property
+    def all_packages(self):
+        try:
+            return self._all_packages
+        except AttributeError:
+            raise AttributeError('all_packages')
+
+    @all_packages.setter
+    def all_packages(self, value):
+        self._all_packages = value
+
+    def keys(self):
+        keys = list(self.columns)
+        for key in self.derived:
+            if hasattr(self, '_' + key):
+                keys.append(key)
+        return keys
+
+    def items(self):
+        return [(key, self[key]) for key in self.keys()]
+
+    def get(self, key, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+    def __getitem__(self, key):
+        if key not in self.columns and key not in self.derived:
+            raise KeyError(key)
+        try:
+            return getattr(self, key)
+        except AttributeError:
+            raise KeyError(key)
+
+    def __setitem__(self, key, value):
+        if key not in self.columns and key not in self.derived:
+            raise KeyError(key)
+        setattr(self, key, value)
+
+    def __contains__(self, key):
+        return key in self.keys()
+
+    def __eq__(self, other):
+        if not hasattr(other, 'keys'):
+            return NotImplemented
+        return dict(self.items()) == dict(
+            (key, other[key]) for key in other.keys())
+
+    def __ne__(self, other):
+        equal = self.__eq__(other)
+        if equal is NotImplemented:
+            return equal
+        return not equal
+
+    __hash__ = None
+
+    def __repr__(self):
+        return repr(dict(self.items()))
+
+
+PackageDiff = collections.namedtuple('PackageDiff', 'new removed unchanged')
+
+
+class FleetPackages(object):
+    # Compares the packages reported by Nagios with the packages already
+    # notified in Mantis for every host at once. Most hosts share the same
+    # few package lists, so each distinct (current, notified) pair is only
+    # compared once.
+    def __init__(self, current, notified):
+        self.diffs = {}
+        self.notified_hosts = set(notified)
+        pairs = {}
+        for hostname, packages in current.items():
+            key = (packages, notified.get(hostname, frozenset()))
+            diff = pairs.get(key)
+            if diff is None:
+                diff = pairs[key] = self.diff(*key)
+            self.diffs[hostname] = diff
+
+        package_lists = collections.Counter(current.values())
+        self.host_counts = collections.Counter()
+        for packages, hosts in package_lists.items():
+            for package in set(packages.split(' ')):
+                self.host_counts[package] += hosts
+
+    @staticmethod
+    def diff(packages, notified):
+        packages = packages.split(' ')
+        current = frozenset(packages)
+        return PackageDiff(
+            new=tuple(package for package in packages
+                      if package not in notified),
+            removed=tuple(sorted(notified - current)),
+            unchanged=tuple(package for package in packages
+                            if package in notified),
+        )
+
+    def up_to_date(self, hostname):
+        return (hostname in self.notified_hosts and
+                not self.diffs[hostname].new)
+
+
+class HostTracer(object):
+    # Collects what was done for each host, written as JSON lines by
+    # --profile
+    def __init__(self, enabled=False):
+        self.enabled = enabled
+        self.traces = []
+        self.current = None
+        self.started = None
+
+    def start(self, hostname):
+        if not self.enabled:
+            return
+        self.current = {
+            'host_name': hostname,
+            'action': 'nothing',
+            'soap_calls': 0,
+            'soap_time': 0.0,
+            'bytes': 0,
+            'parse_time': 0.0,
+            'total_time': 0.0,
+        }
+        self.started = time.time()
+
+    def stop(self):
+        if self.current is None:
+            return
+        self.current['total_time'] = time.time() - self.started
+        self.traces.append(self.current)
+        self.current = None
+
+    def add(self, key, value):
+        if self.current is not None:
+            self.current[key] += value
+
+    def set(self, key, value):
+        if self.current is not None:
+            self.current[key] = value
+
+    def slowest(self, count):
+        return sorted(self.traces, key=lambda trace: trace['total_time'],
+                      reverse=True)[:count]
+
+    def write(self, filename):
+        import json
+        with open(filename, 'w') as trace_file:
+            for trace in self.traces:
+                trace_file.write(json.dumps(trace, sort_keys=True) + '\n')
+
+
+class CountingTransport(object):
+    # Wraps the SOAPpy transport to count the bytes sent to and received
+    # from Mantis
+    def __init__(self, transport, tracer):
+        self.transport = transport
+        self.tracer = tracer
+
+    def call(self, addr, data, *args, **kwargs):
+        response = self.transport.call(addr, data, *args, **kwargs)
+        self.tracer.add('bytes', len(data) + len(response[0]))
+        return response
+
+    def __getattr__(self, name):
+        return getattr(self.transport, name)
+
 
 class DbLink(object):
     def __init__(self, sqlite_filename):
@@ -58,6 +301,21 @@ class DbLink(object):
             'create table if not exists nagios_mantis_link ('
             'hostname text, issue_id integer);'
         )
+        self.db.execute(
+            'create table if not exists nagios_mantis_notified ('
+            'issue_id integer primary key, last_note_id integer, '
+            'packages text);'
+        )
+        self.db.execute(
+            'create table if not exists nagios_mantis_issue ('
+            'issue_id integer primary key, notes_count integer, '
+            'last_updated text, category text, project_id integer, '
+            'description text, summary text);'
+        )
+        self.db.execute(
+            'create table if not exists nagios_mantis_state ('
+            'key text primary key, value text);'
+        )
 
     def add(self, hostname, issue_id):
         db_issue_id = self.get_issue_id(hostname)
@@ -73,6 +331,14 @@ class DbLink(object):
             'delete from nagios_mantis_link where issue_id = :issue_id ;',
             {'issue_id': issue_id}
         )
+        self.db.execute(
+            'delete from nagios_mantis_notified where issue_id = :issue_id ;',
+            {'issue_id': issue_id}
+        )
+        self.db.execute(
+            'delete from nagios_mantis_issue where issue_id = :issue_id ;',
+            {'issue_id': issue_id}
+        )
         self.db.commit()
 
     def get_issue_id(self, hostname):
@@ -90,59 +356,381 @@ class DbLink(object):
         finally:
             cursor.close()
 
+    def links(self):
+        cursor = self.db.cursor()
+        cursor.execute(
+            'select rowid, hostname, issue_id from nagios_mantis_link '
+            'order by issue_id, rowid;'
+        )
+        try:
+            return cursor.fetchall()
+        finally:
+            cursor.close()
+
+    def update_links(self, removed, added):
+        # Links are removed by rowid: the same (hostname, issue_id) pair may
+        # be stored twice and only one of the rows must go
+        with self.db:
+            self.db.executemany(
+                'delete from nagios_mantis_link where rowid = :rowid;',
+                [{'rowid': rowid} for rowid in removed]
+            )
+            self.db.executemany(
+                'insert into nagios_mantis_link (hostname, issue_id) '
+                'values (:hostname, :issue_id);',
+                [{'hostname': hostname, 'issue_id': issue_id}
+                 for hostname, issue_id in added]
+            )
+            self.db.execute(
+                'delete from nagios_mantis_notified where issue_id not in '
+                '(select issue_id from nagios_mantis_link);'
+            )
+            self.db.execute(
+                'delete from nagios_mantis_issue where issue_id not in '
+                '(select issue_id from nagios_mantis_link);'
+            )
+
+    def notified_by_host(self):
+        cursor = self.db.cursor()
+        cursor.execute(
+            'select hostname, packages from nagios_mantis_link '
+            'join nagios_mantis_notified using (issue_id);'
+        )
+        try:
+            return dict((hostname, frozenset(packages.split(' ')))
+                        for hostname, packages in cursor.fetchall())
+        finally:
+            cursor.close()
+
+    def get_notified(self, issue_id):
+        cursor = self.db.cursor()
+        cursor.execute(
+            'select last_note_id, packages from nagios_mantis_notified '
+            'where issue_id = :issue_id;',
+            {'issue_id': issue_id}
+        )
+        try:
+            row = cursor.fetchone()
+            if row is None:
+                return None, None
+            return row[0], set(row[1].split(' '))
+        finally:
+            cursor.close()
+
+    def set_notified(self, issue_id, last_note_id, packages):
+        self.db.execute(
+            'insert or replace into nagios_mantis_notified '
+            '(issue_id, last_note_id, packages) '
+            'values (:issue_id, :last_note_id, :packages);',
+            {'issue_id': issue_id, 'last_note_id': last_note_id,
+             'packages': ' '.join(sorted(packages))}
+        )
+        self.db.commit()
+
+    def get_issue(self, issue_id):
+        cursor = self.db.cursor()
+        cursor.execute(
+            'select notes_count, last_updated, category, project_id, '
+            'description, summary from nagios_mantis_issue '
+            'where issue_id = :issue_id;',
+            {'issue_id': issue_id}
+        )
+        try:
+            row = cursor.fetchone()
+            if row is None:
+                return None
+            return dict(zip(('notes_count', 'last_updated', 'category',
+                             'project_id', 'description', 'summary'), row))
+        finally:
+            cursor.close()
+
+    def set_issue(self, issue_id, issue):
+        params = dict(issue, issue_id=issue_id)
+        self.db.execute(
+            'insert or replace into nagios_mantis_issue (issue_id, '
+            'notes_count, last_updated, category, project_id, description, '
+            'summary) values (:issue_id, :notes_count, :last_updated, '
+            ':category, :project_id, :description, :summary);',
+            params
+        )
+        self.db.commit()
+
+    def get_state(self, key):
+        cursor = self.db.cursor()
+        cursor.execute(
+            'select value from nagios_mantis_state where key = :key;',
+            {'key': key}
+        )
+        try:
+            row = cursor.fetchone()
+            if row is None:
+                return None
+            return row[0]
+        finally:
+            cursor.close()
+
+    def set_state(self, key, value):
+        self.db.execute(
+            'insert or replace into nagios_mantis_state (key, value) '
+            'values (:key, :value);',
+            {'key': key, 'value': value}
+        )
+        self.db.commit()
+
 
 class SecurityUpdatesChecker(object):
+    issue_headers_page_size = 100
+    # reconcile refuses to unlink more hosts missing from Nagios than this
+    # share of the links without force: an empty or partial Livestatus
+    # answer would otherwise drop every link
+    max_decommissioned_ratio = 0.5
+    # Calls that can safely be sent again: retrying mc_issue_add or
+    # mc_issue_note_add after a timeout could create the issue or the note
+    # twice if Mantis already committed the first one
+    idempotent_calls = ('mc_issue_get', 'mc_issue_update', 'mc_issue_exists',
+                        'mc_project_get_issue_headers')
+
     def __init__(self, config):
         self.config = config
         self.db = DbLink(config.sqlite_filename)
+        self.mantis_failures = 0
+        self.failures = 0
+        self.tracer = HostTracer()
+        self.issue_headers = {}
 
     @property
     def mantis(self):
         if not hasattr(self, '_mantis'):
-            self._mantis = WSDL.Proxy(self.config.mantis_wsdl)
+            from SOAPpy import WSDL
+            self._mantis = WSDL.Proxy(self.config.mantis_wsdl,
+                                      timeout=self.config.mantis_timeout)
+            if hasattr(self._mantis, 'soapproxy'):
+                soapproxy = self._mantis.soapproxy
+                soapproxy.transport = CountingTransport(soapproxy.transport,
+                                                        self.tracer)
         return self._mantis
 
+    @property
+    def mantis_circuit_open(self):
+        threshold = self.config.mantis_circuit_threshold
+        return threshold > 0 and self.mantis_failures >= threshold
+
+    @property
+    def mantis_errors(self):
+        import httplib
+        from SOAPpy import faultType
+        from SOAPpy.Errors import HTTPError
+        return (faultType, HTTPError, httplib.HTTPException, socket.error)
+
+    def is_transient_error(self, error):
+        import httplib
+        from SOAPpy.Errors import HTTPError
+        if isinstance(error, (socket.error, httplib.HTTPException)):
+            return True
+        if isinstance(error, HTTPError):
+            # The web server in front of Mantis answers 502/503/504, or
+            # nothing at all, while it is overloaded or restarting
+            return (int(error.code) >= 500 or
+                    str(error.msg).startswith('Empty response'))
+        # Client faults (unknown issue, access denied...) will not go away
+        # by retrying
+        return 'Client' not in str(getattr(error, 'faultcode', ''))
+
+    def mantis_call(self, method, *args):
+        attempt = 0
+        while True:
+            if self.mantis_circuit_open:
+                raise MantisUnavailable('%d consecutive failures calling '
+                                        'Mantis' % self.mantis_failures)
+            self.tracer.add('soap_calls', 1)
+            started = time.time()
+            try:
+                result = getattr(self.mantis, method)(
+                    self.config.mantis_username,
+                    self.config.mantis_password,
+                    *args
+                )
+            except self.mantis_errors as error:
+                if not self.is_transient_error(error):
+                    self.mantis_failures = 0
+                    raise
+                self.mantis_failures += 1
+                if (method not in self.idempotent_calls or
+                        attempt >= self.config.mantis_retries or
+                        self.mantis_circuit_open):
+                    raise
+                delay = random.uniform(
+                    0, self.config.mantis_retry_backoff * 2 ** attempt)
+                logging.warning('Mantis call %s failed, retrying in %.2fs',
+                                method, delay)
+                time.sleep(delay)
+                attempt += 1
+            else:
+                self.mantis_failures = 0
+                return result
+            finally:
+                self.tracer.add('soap_time', time.time() - started)
+
     @property
     def nagios(self):
         if not hasattr(self, '_nagios'):
+            from mk_livestatus import Socket
             self._nagios = Socket((self.config.nagios_host,
                                    self.config.nagios_port))
         return self._nagios
 
-    def _nagios_request(self):
+    def _nagios_request(self, since=None):
         request = self.nagios.services
         request.columns('host_name', 'plugin_output', 'host_notes')
         request.filter('service_description = security')
+        if since is not None:
+            request.filter('last_state_change >= %d' % since)
         return request
 
-    def _nagios_errors(self):
-        request = self._nagios_request()
+    def _nagios_errors(self, since=None):
+        request = self._nagios_request(since)
         request.filter('state != 0')
         return request.call()
 
-    def _nagios_ok(self):
-        request = self._nagios_request()
+    def _nagios_ok(self, since=None):
+        request = self._nagios_request(since)
         request.filter('state = 0')
         return request.call()
 
-    def check_errors(self):
+    def _nagios_all(self):
+        return self._nagios_request().call()
+
+    def _nagios_call(self, query, *args):
         try:
-            nagios_errors = self._nagios_errors()
+            return HostStatus.from_rows(query(*args))
         except socket.error:
             logging.exception('Cannot connect to Nagios')
             sys.exit(1)
+
+    def nagios_digest(self, nagios_errors, nagios_ok):
+        digest = hashlib.sha1()
+        for state, lines in (('errors', nagios_errors), ('ok', nagios_ok)):
+            rows = sorted(
+                (line['host_name'], line['plugin_output'], line['host_notes'])
+                for line in lines
+            )
+            digest.update(repr((state, rows)).encode('utf-8'))
+        return digest.hexdigest()
+
+    def changed_since(self, now, force=False):
+        # Only services whose state changed since the last successful run
+        # are fetched, except for a periodic full sweep which also catches
+        # package lists changing while a host stays in error. last_run comes
+        # from the local clock and last_state_change from the Nagios one, so
+        # the window is widened by a margin: treating a host twice is
+        # harmless, missing a state change is not.
+        interval = self.config.nagios_full_sweep_interval
+        last_run = self.db.get_state('last_run')
+        last_full_sweep = self.db.get_state('last_full_sweep')
+        if (force or not interval or last_run is None or
+                last_full_sweep is None or
+                now - int(last_full_sweep) >= interval):
+            return None
+        return int(last_run) - self.config.nagios_clock_skew_margin
+
+    def save_run(self, started, since):
+        self.db.set_state('last_run', started)
+        if since is None:
+            self.db.set_state('last_full_sweep', started)
+
+    def run(self, force=False):
+        started = int(time.time())
+        since = self.changed_since(started, force)
+        nagios_errors = self._nagios_call(self._nagios_errors, since)
+        nagios_ok = self._nagios_call(self._nagios_ok, since)
+        digest = self.nagios_digest(nagios_errors, nagios_ok)
+        if not force and digest == self.db.get_state('nagios_digest'):
+            logging.info('Nothing changed in Nagios since the last run')
+            self.save_run(started, since)
+            return
+
+        self.failures = 0
+        self.load_issue_headers(nagios_errors + nagios_ok)
+        self.check_errors(nagios_errors)
+        self.check_okays(nagios_ok)
+        # Hosts that failed on a transient error must be treated again on the
+        # next run
+        if not self.failures:
+            self.db.set_state('nagios_digest', digest)
+            self.save_run(started, since)
+
+    def parsed_lines(self, nagios_errors):
+        lines = []
         for line in nagios_errors:
+            if line['packages'] is None:
+                logging.warning('Cannot parse the packages of %s: %s',
+                                line['host_name'], line['plugin_output'])
+            else:
+                lines.append(line)
+        return lines
+
+    def fleet_packages(self, nagios_errors):
+        current = dict((line['host_name'], line['packages'])
+                       for line in nagios_errors)
+        return FleetPackages(current, self.db.notified_by_host())
+
+    def check_errors(self, nagios_errors=None):
+        if nagios_errors is None:
+            nagios_errors = self._nagios_call(self._nagios_errors)
+        nagios_errors = self.parsed_lines(nagios_errors)
+        # Hosts whose packages have all been notified already, on an issue
+        # still open, need no Mantis call at all
+        fleet = self.fleet_packages(nagios_errors)
+        lines = [line for line in nagios_errors
+                 if not (fleet.up_to_date(line['host_name']) and
+                         self.issue_open(line['host_name']))]
+        if len(lines) < len(nagios_errors):
+            logging.info('%d hosts have no new package to notify',
+                         len(nagios_errors) - len(lines))
+        self._check_lines(lines, self.check_error)
+
+    def issue_open(self, hostname):
+        # Only the headers loaded for this run tell whether the issue was
+        # resolved by hand since it was last fetched
+        header = self.issue_headers.get(self.db.get_issue_id(hostname))
+        return (header is not None and
+                self.get_status_id(header) != self.config.mantis_status_id)
+
+    def report(self):
+        nagios_errors = self._nagios_call(self._nagios_errors)
+        return self.fleet_packages(
+            self.parsed_lines(nagios_errors)).host_counts
+
+    def _check_lines(self, lines, check):
+        for line in lines:
+            self.tracer.start(line['host_name'])
             try:
-                self.check_error(line)
-            except faultType:
+                check(line)
+            except MantisUnavailable:
+                self.failures += 1
+                self.tracer.set('action', 'error')
+                logging.exception('Mantis is unavailable, skipping the '
+                                  'remaining hosts')
+                return
+            except self.mantis_errors as error:
+                # Permanent errors (an issue deleted by hand...) would block
+                # the digest and the incremental window forever: leave them
+                # to reconcile
+                if self.is_transient_error(error):
+                    self.failures += 1
+                self.tracer.set('action', 'error')
                 logging.exception('An error occured connecting to Mantis '
                                   'while treating %s', line)
             except sqlite3.Error:
+                self.failures += 1
+                self.tracer.set('action', 'error')
                 logging.exception('An error occured with sqlite3 database '
                                   'while treating %s', line)
+            finally:
+                self.tracer.stop()
 
     def check_error(self, line):
-        line['packages'] = line['plugin_output'].split(': ')[1]
+        line = HostStatus.from_row(line)
         mantis_issue = self.find_issue(line)
         if mantis_issue:
             notified_packages = self.find_notified_packages(mantis_issue)
@@ -153,25 +741,18 @@ class SecurityUpdatesChecker(object):
                 mantis_issue['status']['id'] != self.config.mantis_status_id):
             self.mantis_add_note(mantis_issue, line)
         else:
+            if mantis_issue:
+                # Resolved by hand: the host gets a new issue
+                self.db.delete(mantis_issue['id'])
             self.mantis_add_issue(line)
 
-    def check_okays(self):
-        try:
-            nagios_ok = self._nagios_ok()
-        except socket.error:
-            logging.exception('Cannot connect to Nagios')
-            sys.exit(1)
-        for line in nagios_ok:
-            try:
-                self.check_okay(line)
-            except faultType:
-                logging.exception('An error occured connecting to Mantis '
-                                  'while treating %s', line)
-            except sqlite3.Error:
-                logging.exception('An error occured with sqlite3 database '
-                                  'while treating %s', line)
+    def check_okays(self, nagios_ok=None):
+        if nagios_ok is None:
+            nagios_ok = self._nagios_call(self._nagios_ok)
+        self._check_lines(nagios_ok, self.check_okay)
 
     def check_okay(self, line):
+        line = HostStatus.from_row(line)
         mantis_issue = self.find_issue(line)
         if mantis_issue:
             notified_packages = self.find_notified_packages(mantis_issue)
@@ -180,31 +761,105 @@ class SecurityUpdatesChecker(object):
                 mantis_issue['status']['id'] != self.config.mantis_status_id):
             self.mantis_close_issue(mantis_issue, line)
 
+    def load_issue_headers(self, lines):
+        # The headers carry no notes: comparing their notes_count and
+        # last_updated with the stored ones tells whether an issue changed
+        # without downloading its whole history
+        self.issue_headers = {}
+        links = self.db.links()
+        linked = set(link[1] for link in links)
+        lines = [line for line in lines if line['host_name'] in linked]
+        # The headers of every issue of the projects are paged through, which
+        # only pays off when it takes fewer calls than fetching each issue to
+        # check. The projects hold at least every linked issue.
+        page_size = self.issue_headers_page_size
+        min_pages = (len(set(link[2] for link in links)) + page_size - 1) \
+            // page_size
+        if not lines or len(lines) < min_pages:
+            return
+        project_ids = set(self.get_nagios_project_id(line) for line in lines)
+        try:
+            self.issue_headers = self.mantis_category_issues(
+                sorted(project_ids), max_pages=len(lines))
+        except self.mantis_errors + (MantisUnavailable,):
+            logging.exception('Cannot load the Mantis issue headers, every '
+                              'linked issue will be fetched')
+
+    def cached_issue(self, issue_id, header):
+        issue = self.db.get_issue(issue_id)
+        if (issue is None or
+                issue['notes_count'] != int(header['notes_count']) or
+                issue['last_updated'] != str(header['last_updated']) or
+                self.db.get_notified(issue_id)[0] is None):
+            return None
+        # Every note is already accounted for in the notified packages
+        return {
+            'id': issue_id,
+            'status': {'id': self.get_status_id(header)},
+            'category': issue['category'],
+            'project': {'id': issue['project_id']},
+            'description': issue['description'],
+            'summary': issue['summary'],
+            'notes': [],
+        }
+
     def find_issue(self, line):
         issue_id = self.db.get_issue_id(line['host_name'])
         if not issue_id:
             return None
-        return self.mantis.mc_issue_get(
-            self.config.mantis_username,
-            self.config.mantis_password,
-            issue_id
-        )
+        header = self.issue_headers.get(issue_id)
+        if header is not None:
+            mantis_issue = self.cached_issue(issue_id, header)
+            if mantis_issue is not None:
+                return mantis_issue
+        mantis_issue = self.mantis_call('mc_issue_get', issue_id)
+        if header is not None:
+            self.db.set_issue(issue_id, {
+                'notes_count': int(header['notes_count']),
+                'last_updated': str(header['last_updated']),
+                'category': mantis_issue['category'],
+                'project_id': mantis_issue['project']['id'],
+                'description': mantis_issue['description'],
+                'summary': mantis_issue['summary'],
+            })
+        return mantis_issue
+
+    def parse_template(self, template, text):
+        from parse import parse
+        return parse(template.replace('%(', '{').replace(')s', '}'), text)
 
     def find_notified_packages(self, mantis_issue):
-        template_clean = lambda s: s.replace('%(', '{').replace(')s', '}')
-        packages = set()
-        parsed_desc = parse(
-            template_clean(self.config.template_description),
-            mantis_issue['description']
-        )
-        packages.update(parsed_desc['packages'].split(' '))
-        if mantis_issue['notes']:
-            for note in mantis_issue['notes']:
-                parsed_note = parse(
-                    template_clean(self.config.template_note),
-                    note['text']
-                )
+        # The packages found in the description and the notes up to
+        # last_note_id are stored, so only the notes added since the
+        # previous run are parsed, however long the history of the issue.
+        started = time.time()
+        last_note_id, packages = self.db.get_notified(mantis_issue['id'])
+        known_note_id = last_note_id
+        if packages is None:
+            packages = set()
+            parsed_desc = self.parse_template(
+                self.config.template_description,
+                mantis_issue['description']
+            )
+            # Descriptions and notes edited by people may not follow the
+            # templates
+            if parsed_desc:
+                packages.update(parsed_desc['packages'].split(' '))
+            last_note_id = 0
+        for note in mantis_issue['notes'] or []:
+            note_id = int(note['id'])
+            if note_id <= last_note_id:
+                continue
+            parsed_note = self.parse_template(
+                self.config.template_note,
+                note['text']
+            )
+            if parsed_note:
                 packages.update(parsed_note['packages'].split(' '))
+            last_note_id = max(last_note_id, note_id)
+        if last_note_id != known_note_id:
+            self.db.set_notified(mantis_issue['id'], last_note_id, packages)
+        self.tracer.add('parse_time', time.time() - started)
         return packages
 
     def find_new_packages(self, mantis_issue, current_packages):
@@ -219,27 +874,23 @@ class SecurityUpdatesChecker(object):
         new_packages = self.find_new_packages(mantis_issue, line['packages'])
         if not new_packages:
             return
-        self.mantis.mc_issue_note_add(
-            self.config.mantis_username,
-            self.config.mantis_password,
+        self.mantis_call(
+            'mc_issue_note_add',
             mantis_issue['id'],
             {'text': self.config.template_note % {
                 'packages': ' '.join(new_packages)
             }}
         )
+        self.tracer.set('action', 'add_note')
 
         line['all_packages'] += ' ' + ' '.join(new_packages)
         issue = self.get_issue_for_update(mantis_issue)
         issue['summary'] = self.config.template_summary % line
-        self.mantis.mc_issue_update(
-            self.config.mantis_username,
-            self.config.mantis_password,
-            mantis_issue['id'],
-            issue
-        )
+        self.mantis_call('mc_issue_update', mantis_issue['id'], issue)
 
     def get_nagios_project_id(self, line):
         if 'host_notes' in line and line['host_notes']:
+            import yaml
             host_notes = yaml.load(line['host_notes'])
             return host_notes['mantis_project_id']
         return self.config.mantis_project_id
@@ -252,32 +903,126 @@ class SecurityUpdatesChecker(object):
             'category': self.config.mantis_category,
             'project': {'id': project_id}
         }
-        issue_id = self.mantis.mc_issue_add(
-            self.config.mantis_username,
-            self.config.mantis_password,
-            issue
-        )
+        issue_id = self.mantis_call('mc_issue_add', issue)
+        self.tracer.set('action', 'add_issue')
         self.db.add(line['host_name'], issue_id)
 
     def mantis_close_issue(self, mantis_issue, line):
-        self.mantis.mc_issue_note_add(
-            self.config.mantis_username,
-            self.config.mantis_password,
+        self.mantis_call(
+            'mc_issue_note_add',
             mantis_issue['id'],
             {'text': self.config.template_close % line}
         )
+        self.tracer.set('action', 'close')
 
         issue = self.get_issue_for_update(mantis_issue)
         issue['summary'] = self.config.template_summary % line
         issue['status'] = {'id': self.config.mantis_status_id}
-        self.mantis.mc_issue_update(
-            self.config.mantis_username,
-            self.config.mantis_password,
-            mantis_issue['id'],
-            issue
-        )
+        self.mantis_call('mc_issue_update', mantis_issue['id'], issue)
         self.db.delete(mantis_issue['id'])
 
+    def get_status_id(self, mantis_issue):
+        # Issue headers only carry the status id, full issues an ObjectRef
+        status = mantis_issue['status']
+        try:
+            return int(status)
+        except TypeError:
+            return status['id']
+
+    def mantis_category_issues(self, project_ids, max_pages=None):
+        issues = {}
+        seen = set()
+        page_size = self.issue_headers_page_size
+        pages = 0
+        for project_id in project_ids:
+            page = 1
+            while max_pages is None or pages < max_pages:
+                pages += 1
+                headers = self.mantis_call('mc_project_get_issue_headers',
+                                           project_id, page, page_size)
+                # Mantis sends the last page again when asked for a page
+                # past the end
+                if not headers or headers[0]['id'] in seen:
+                    break
+                for header in headers:
+                    seen.add(header['id'])
+                    if header['category'] == self.config.mantis_category:
+                        issues[header['id']] = header
+                if len(headers) < page_size:
+                    break
+                page += 1
+        return issues
+
+    def _link_action(self, hostname, issue_id, issues, hostnames, linked):
+        if issue_id not in issues:
+            # Not in the headers: either deleted, or in a project or
+            # category this run did not list
+            if not self.mantis_call('mc_issue_exists', issue_id):
+                return 'deleted'
+            issues[issue_id] = self.mantis_call('mc_issue_get', issue_id)
+        if (self.get_status_id(issues[issue_id]) >=
+                self.config.mantis_status_id):
+            return 'resolved'
+        if hostname not in hostnames:
+            return 'decommissioned'
+        if hostname in linked:
+            return 'duplicate'
+        return None
+
+    def reconcile(self, dry_run=False, force=False):
+        nagios_lines = self._nagios_call(self._nagios_all)
+        hostnames = set(line['host_name'] for line in nagios_lines)
+        project_ids = set([self.config.mantis_project_id])
+        project_ids.update(self.get_nagios_project_id(line)
+                           for line in nagios_lines)
+        issues = self.mantis_category_issues(sorted(project_ids))
+
+        report = {'deleted': [], 'resolved': [], 'decommissioned': [],
+                  'duplicate': [], 'relinked': []}
+        removed = dict((action, []) for action in report)
+        linked = {}
+        links = self.db.links()
+        for rowid, hostname, issue_id in links:
+            action = self._link_action(hostname, issue_id, issues, hostnames,
+                                       linked)
+            if action is None:
+                linked[hostname] = issue_id
+                continue
+            report[action].append((hostname, issue_id))
+            removed[action].append(rowid)
+
+        decommissioned = len(report['decommissioned'])
+        if (decommissioned and not force and
+                decommissioned > self.max_decommissioned_ratio * len(links)):
+            logging.error('%d of the %d links are for hosts missing from '
+                          'Nagios, keeping them (use force to unlink them)',
+                          decommissioned, len(links))
+            report['decommissioned'] = []
+            removed['decommissioned'] = []
+
+        linked_ids = set(linked.values())
+        for issue_id in sorted(issues, reverse=True):
+            issue = issues[issue_id]
+            if (issue_id in linked_ids or self.get_status_id(issue) >=
+                    self.config.mantis_status_id):
+                continue
+            parsed = self.parse_template(self.config.template_summary,
+                                         issue['summary'])
+            if not parsed:
+                continue
+            hostname = parsed['host_name']
+            if hostname in hostnames and hostname not in linked:
+                linked[hostname] = issue_id
+                report['relinked'].append((hostname, issue_id))
+
+        for action in sorted(report):
+            for hostname, issue_id in report[action]:
+                logging.info('%s: %s -> #%d', action, hostname, issue_id)
+        if not dry_run:
+            self.db.update_links(sum(removed.values(), []),
+                                 report['relinked'])
+        return report
+
     def get_issue_for_update(self, mantis_issue):
         issue = {}
         for key in ['category', 'project', 'description', 'summary']:
@@ -291,16 +1036,60 @@ class SecurityUpdatesChecker(object):
 def main():  # pragma: nocover
     parser = argparse.ArgumentParser(description='Sends Nagios security '
                                      'update alerts to Mantis')
+    parser.add_argument('command', nargs='?', default='check',
+                        choices=['check', 'reconcile', 'report'],
+                        help='check (default) sends Nagios alerts to Mantis, '
+                        'reconcile repairs the links between hosts and '
+                        'Mantis issues, report counts the hosts needing '
+                        'each package update')
     parser.add_argument('-c', '--configuration-file',
                         help='INI file containing configuration',
                         default='/etc/nagios2mantis_security.ini')
+    parser.add_argument('-f', '--force', action='store_true',
+                        help='Check every host even if nothing changed in '
+                        'Nagios since the last run; with reconcile, unlink '
+                        'hosts missing from Nagios however many they are')
+    parser.add_argument('-n', '--dry-run', action='store_true',
+                        help='With reconcile, only report what would change')
+    parser.add_argument('-p', '--profile', metavar='PREFIX',
+                        help='Write a cProfile dump to PREFIX.prof and a '
+                        'per-host trace to PREFIX.trace.jsonl')
+    parser.add_argument('--profile-top', type=int, default=10,
+                        help='Number of slowest hosts listed with --profile')
     args = parser.parse_args()
 
     config = Config(args.configuration_file)
     checker = SecurityUpdatesChecker(config)
 
-    checker.check_errors()
-    checker.check_okays()
+    if args.command == 'reconcile':
+        logging.basicConfig(level=logging.INFO, format='%(message)s')
+        command = functools.partial(checker.reconcile, args.dry_run,
+                                    args.force)
+    elif args.command == 'report':
+        command = checker.report
+    else:
+        command = functools.partial(checker.run, args.force)
+
+    if args.profile:
+        import cProfile
+        checker.tracer.enabled = True
+        profiler = cProfile.Profile()
+        report = profiler.runcall(command)
+        profiler.dump_stats(args.profile + '.prof')
+        checker.tracer.write(args.profile + '.trace.jsonl')
+        for trace in checker.tracer.slowest(args.profile_top):
+            print('%(total_time)8.3fs %(soap_calls)3d calls %(bytes)9d bytes '
+                  '%(parse_time)7.3fs parsing  %(action)-9s %(host_name)s'
+                  % trace)
+    else:
+        report = command()
+
+    if args.command == 'reconcile':
+        for action in sorted(report):
+            print('%s: %d' % (action, len(report[action])))
+    elif args.command == 'report':
+        for package, count in report.most_common():
+            print('%6d %s' % (count, package))
 
 
 if __name__ == '__main__':  # pragma: nocover
@@ -1,21 +1,32 @@
 import unittest
 import socket
+import httplib
 import sqlite3
+import json
 
 import mock
 from SOAPpy import faultType
+from SOAPpy.Errors import HTTPError
 
 from nagios2mantis_security import SecurityUpdatesChecker
 from nagios2mantis_security import Config
 from nagios2mantis_security import DbLink
+from nagios2mantis_security import MantisUnavailable
+from nagios2mantis_security import HostStatus
+from nagios2mantis_security import HostTracer
+from nagios2mantis_security import CountingTransport
+from nagios2mantis_security import FleetPackages
+from nagios2mantis_security import PackageDiff
 
 
 class MantisMock(object):
-    def __init__(self, url):
+    def __init__(self, url, timeout=None):
         self.mc_issue_note_add = mock.Mock()
         self.mc_issue_add = mock.Mock()
         self.mc_issue_get = mock.Mock()
         self.mc_issue_update = mock.Mock()
+        self.mc_issue_exists = mock.Mock()
+        self.mc_project_get_issue_headers = mock.Mock()
 
 
 class MantisIssueNotFoundMock(MantisMock):
@@ -24,11 +35,13 @@ class MantisIssueNotFoundMock(MantisMock):
         self.mc_issue_get_id_from_summary = mock.Mock(return_value=None)
 
 
-class TestN2MSecurity(unittest.TestCase):
+class CheckerTestCase(unittest.TestCase):
     def setUp(self):
         self.config = Config('nagios2mantis_security.ini')
         self.config.sqlite_filename = ':memory:'
 
+
+class TestN2MSecurity(CheckerTestCase):
     @mock.patch('SOAPpy.WSDL.Proxy', MantisMock)
     def test_mantis_add_issue(self):
         checker = SecurityUpdatesChecker(self.config)
@@ -167,12 +180,15 @@ class TestN2MSecurity(unittest.TestCase):
         checker = SecurityUpdatesChecker(self.config)
         new_packages = checker.find_new_packages(
             {
+                'id': 42,
                 'description': 'The following packages have security updates '
                                'available : python-django',
                 'notes': [
-                    {'text': 'This packages also have security updates : '
+                    {'id': 1,
+                     'text': 'This packages also have security updates : '
                              'python-soappy'},
-                    {'text': 'This packages also have security updates : '
+                    {'id': 2,
+                     'text': 'This packages also have security updates : '
                              'python-mock'},
 
                 ],
@@ -181,6 +197,60 @@ class TestN2MSecurity(unittest.TestCase):
         )
         self.assertEquals(new_packages, ['python-flask'])
 
+    @mock.patch('SOAPpy.WSDL.Proxy', MantisMock)
+    def test_find_notified_packages_incremental(self):
+        checker = SecurityUpdatesChecker(self.config)
+        mantis_issue = {
+            'id': 42,
+            'description': 'The following packages have security updates '
+                           'available : python-django',
+            'notes': [
+                {'id': 1,
+                 'text': 'This packages also have security updates : '
+                         'python-soappy'},
+                {'id': 2, 'text': 'Will be updated next week'},
+            ],
+        }
+
+        self.assertEquals(checker.find_notified_packages(mantis_issue),
+                          set(['python-django', 'python-soappy']))
+        self.assertEquals(checker.db.get_notified(42),
+                          (2, set(['python-django', 'python-soappy'])))
+
+        mantis_issue['description'] = 'Not parsed anymore'
+        mantis_issue['notes'][0]['text'] = 'Not parsed anymore'
+        mantis_issue['notes'].append(
+            {'id': 3, 'text': 'This packages also have security updates : '
+                              'python-mock'})
+        with mock.patch.object(checker.db, 'set_notified',
+                               wraps=checker.db.set_notified) as set_mock:
+            packages = checker.find_notified_packages(mantis_issue)
+            checker.find_notified_packages(mantis_issue)
+
+        self.assertEquals(
+            packages, set(['python-django', 'python-soappy', 'python-mock']))
+        self.assertEquals(1, set_mock.call_count)
+
+        checker.db.add('localhost', 42)
+        checker.db.delete(42)
+        self.assertEquals(checker.db.get_notified(42), (None, None))
+
+    @mock.patch('SOAPpy.WSDL.Proxy', MantisMock)
+    def test_find_notified_packages_description_edited(self):
+        checker = SecurityUpdatesChecker(self.config)
+        mantis_issue = {
+            'id': 42,
+            'description': 'Edited by hand',
+            'notes': [
+                {'id': 1,
+                 'text': 'This packages also have security updates : '
+                         'python-soappy'},
+            ],
+        }
+
+        self.assertEquals(checker.find_notified_packages(mantis_issue),
+                          set(['python-soappy']))
+
     @mock.patch('SOAPpy.WSDL.Proxy', MantisMock)
     def test_find_issue_not_found(self):
         checker = SecurityUpdatesChecker(self.config)
@@ -231,6 +301,66 @@ class TestN2MSecurity(unittest.TestCase):
             ('host_name', 'plugin_output', 'host_notes')
         )
 
+    @mock.patch('SOAPpy.WSDL.Proxy', MantisMock)
+    def test_nagios_errors_since(self):
+        checker = SecurityUpdatesChecker(self.config)
+        checker.nagios.call = mock.Mock()
+        checker._nagios_errors(1380000000)
+
+        checker.nagios.call.assert_called_once_with(
+            'GET services\n'
+            'Columns: host_name plugin_output host_notes\n'
+            'Filter: service_description = security\n'
+            'Filter: last_state_change >= 1380000000\n'
+            'Filter: state != 0\n\n',
+            ('host_name', 'plugin_output', 'host_notes')
+        )
+
+    def test_changed_since(self):
+        self.config.nagios_full_sweep_interval = 3600
+        self.config.nagios_clock_skew_margin = 60
+        checker = SecurityUpdatesChecker(self.config)
+        self.assertIsNone(checker.changed_since(1000))
+
+        checker.save_run(1000, None)
+        self.assertEquals(940, checker.changed_since(2000))
+        self.assertIsNone(checker.changed_since(2000, force=True))
+
+        checker.save_run(2000, 940)
+        self.assertEquals(1940, checker.changed_since(3000))
+        self.assertIsNone(checker.changed_since(4600))
+
+        self.config.nagios_full_sweep_interval = 0
+        self.assertIsNone(checker.changed_since(3000))
+
+    def test_run_incremental(self):
+        checker = SecurityUpdatesChecker(self.config)
+        checker._nagios_errors = mock.Mock(return_value=[])
+        checker._nagios_ok = mock.Mock(return_value=[])
+
+        with mock.patch('time.time', return_value=1000):
+            checker.run()
+        with mock.patch('time.time', return_value=2000):
+            checker.run()
+
+        checker._nagios_errors.assert_has_calls(
+            [mock.call(None), mock.call(700)])
+        self.assertEquals(2000, int(checker.db.get_state('last_run')))
+        self.assertEquals(1000, int(checker.db.get_state('last_full_sweep')))
+
+    @mock.patch('SOAPpy.WSDL.Proxy', MantisMock)
+    def test_nagios_all(self):
+        checker = SecurityUpdatesChecker(self.config)
+        checker.nagios.call = mock.Mock()
+        checker._nagios_all()
+
+        checker.nagios.call.assert_called_once_with(
+            'GET services\n'
+            'Columns: host_name plugin_output host_notes\n'
+            'Filter: service_description = security\n\n',
+            ('host_name', 'plugin_output', 'host_notes')
+        )
+
     @mock.patch('SOAPpy.WSDL.Proxy', MantisMock)
     def test_check_errors(self):
         checker = SecurityUpdatesChecker(self.config)
@@ -511,6 +641,875 @@ class TestN2MSecurity(unittest.TestCase):
 
         self.assertFalse(checker.mantis_close_issue.called)
 
+    def test_nagios_digest(self):
+        checker = SecurityUpdatesChecker(self.config)
+        line1 = {
+            'host_name': 'localhost',
+            'plugin_output': 'Packages: python-django',
+            'host_notes': '',
+        }
+        line2 = {
+            'host_name': 'host2',
+            'plugin_output': 'OK',
+            'host_notes': '',
+        }
+
+        digest = checker.nagios_digest([line1], [line2])
+
+        self.assertEquals(digest, checker.nagios_digest([line1], [line2]))
+        self.assertNotEquals(digest, checker.nagios_digest([line2], [line1]))
+        self.assertNotEquals(digest, checker.nagios_digest([line1], []))
+
+    def test_run(self):
+        checker = SecurityUpdatesChecker(self.config)
+        line1 = {
+            'host_name': 'localhost',
+            'plugin_output': 'Packages: python-django',
+            'host_notes': '',
+        }
+        checker._nagios_errors = mock.Mock(return_value=[line1])
+        checker._nagios_ok = mock.Mock(return_value=[])
+        checker.check_error = mock.Mock()
+
+        checker.run()
+        checker.run()
+
+        checker.check_error.assert_called_once_with(line1)
+        self.assertEquals(checker.db.get_state('nagios_digest'),
+                          checker.nagios_digest([line1], []))
+
+    def test_run_force(self):
+        checker = SecurityUpdatesChecker(self.config)
+        checker._nagios_errors = mock.Mock(return_value=[])
+        checker._nagios_ok = mock.Mock(return_value=[])
+        checker.check_errors = mock.Mock()
+
+        checker.run()
+        checker.run(force=True)
+
+        self.assertEquals(2, checker.check_errors.call_count)
+
+    def test_run_failure(self):
+        checker = SecurityUpdatesChecker(self.config)
+        line1 = {
+            'host_name': 'localhost',
+            'plugin_output': 'Packages: python-django',
+            'host_notes': '',
+        }
+        checker._nagios_errors = mock.Mock(return_value=[line1])
+        checker._nagios_ok = mock.Mock(return_value=[])
+        checker.check_error = mock.Mock(side_effect=sqlite3.Error)
+
+        with mock.patch('logging.exception'):
+            checker.run()
+            checker.run()
+
+        self.assertEquals(2, checker.check_error.call_count)
+        self.assertIsNone(checker.db.get_state('nagios_digest'))
+
+    def test_run_permanent_failure(self):
+        checker = SecurityUpdatesChecker(self.config)
+        line1 = {
+            'host_name': 'localhost',
+            'plugin_output': 'Packages: python-django',
+            'host_notes': '',
+        }
+        checker._nagios_errors = mock.Mock(return_value=[line1])
+        checker._nagios_ok = mock.Mock(return_value=[])
+        checker.check_error = mock.Mock(side_effect=faultType(
+            'SOAP-ENV:Client', 'Issue #42 not found'))
+
+        with mock.patch('logging.exception'),\
+                mock.patch('time.time', return_value=1000):
+            checker.run()
+
+        self.assertEquals(checker.db.get_state('nagios_digest'),
+                          checker.nagios_digest([line1], []))
+        self.assertEquals(1000, int(checker.db.get_state('last_run')))
+
+
+class IssueCacheTest(CheckerTestCase):
+    def setUp(self):
+        super(IssueCacheTest, self).setUp()
+        self.header = {
+            'id': 42,
+            'category': 'General',
+            'status': 10,
+            'notes_count': 2,
+            'last_updated': '2013-10-01T12:00:00',
+        }
+        self.mantis_issue = {
+            'id': 42,
+            'status': {'id': 10},
+            'category': 'General',
+            'project': {'id': 1, 'name': 'Project'},
+            'summary': 'Security updates available for host localhost : '
+                       'python-django',
+            'description': 'The following packages have security updates '
+                           'available : python-django',
+            'notes': [
+                {'id': 1, 'text': 'Looking into it'},
+                {'id': 2,
+                 'text': 'This packages also have security updates : '
+                         'python-soappy'},
+            ],
+        }
+
+    @mock.patch('SOAPpy.WSDL.Proxy', MantisMock)
+    def test_find_issue_cached(self):
+        checker = SecurityUpdatesChecker(self.config)
+        checker.db.add('localhost', 42)
+        checker.issue_headers = {42: self.header}
+        checker.mantis.mc_issue_get.return_value = self.mantis_issue
+
+        issue = checker.find_issue({'host_name': 'localhost'})
+        checker.find_notified_packages(issue)
+        self.header['status'] = 80
+        cached = checker.find_issue({'host_name': 'localhost'})
+
+        checker.mantis.mc_issue_get.assert_called_once_with(
+            'mantis_login', 'mantis_password', 42)
+        self.assertEquals(cached, {
+            'id': 42,
+            'status': {'id': 80},
+            'category': 'General',
+            'project': {'id': 1},
+            'summary': self.mantis_issue['summary'],
+            'description': self.mantis_issue['description'],
+            'notes': [],
+        })
+        self.assertEquals(checker.find_notified_packages(cached),
+                          set(['python-django', 'python-soappy']))
+
+    @mock.patch('SOAPpy.WSDL.Proxy', MantisMock)
+    def test_find_issue_changed(self):
+        checker = SecurityUpdatesChecker(self.config)
+        checker.db.add('localhost', 42)
+        checker.issue_headers = {42: self.header}
+        checker.mantis.mc_issue_get.return_value = self.mantis_issue
+
+        checker.find_notified_packages(
+            checker.find_issue({'host_name': 'localhost'}))
+        self.header['notes_count'] = 3
+        issue = checker.find_issue({'host_name': 'localhost'})
+
+        self.assertIs(issue, self.mantis_issue)
+        self.assertEquals(2, checker.mantis.mc_issue_get.call_count)
+        self.assertEquals(checker.db.get_issue(42)['notes_count'], 3)
+
+        checker.db.delete(42)
+        self.assertIsNone(checker.db.get_issue(42))
+
+    @mock.patch('SOAPpy.WSDL.Proxy', MantisMock)
+    def test_find_issue_not_parsed(self):
+        checker = SecurityUpdatesChecker(self.config)
+        checker.db.add('localhost', 42)
+        checker.issue_headers = {42: self.header}
+        checker.mantis.mc_issue_get.return_value = self.mantis_issue
+
+        checker.find_issue({'host_name': 'localhost'})
+        checker.find_issue({'host_name': 'localhost'})
+
+        self.assertEquals(2, checker.mantis.mc_issue_get.call_count)
+
+    @mock.patch('SOAPpy.WSDL.Proxy', MantisMock)
+    def test_load_issue_headers(self):
+        checker = SecurityUpdatesChecker(self.config)
+        checker.db.add('localhost', 42)
+        checker.mantis.mc_project_get_issue_headers.return_value = [
+            self.header]
+
+        checker.load_issue_headers([
+            {'host_name': 'localhost', 'host_notes': 'mantis_project_id: 3'},
+            {'host_name': 'host2', 'host_notes': ''},
+        ])
+
+        self.assertEquals(checker.issue_headers, {42: self.header})
+        checker.mantis.mc_project_get_issue_headers.assert_called_once_with(
+            'mantis_login', 'mantis_password', 3, 1, 100)
+
+    @mock.patch('SOAPpy.WSDL.Proxy', MantisMock)
+    def test_load_issue_headers_unlinked(self):
+        checker = SecurityUpdatesChecker(self.config)
+        checker.issue_headers = {42: self.header}
+
+        checker.load_issue_headers([{'host_name': 'localhost'}])
+
+        self.assertEquals(checker.issue_headers, {})
+        self.assertFalse(checker.mantis.mc_project_get_issue_headers.called)
+
+    @mock.patch('SOAPpy.WSDL.Proxy', MantisMock)
+    def test_load_issue_headers_error(self):
+        checker = SecurityUpdatesChecker(self.config)
+        checker.db.add('localhost', 42)
+        checker.mantis.mc_project_get_issue_headers.side_effect = faultType(
+            'SOAP-ENV:Client', 'Access denied')
+
+        with mock.patch('logging.exception') as exc_mock:
+            checker.load_issue_headers([{'host_name': 'localhost'}])
+
+        self.assertEquals(checker.issue_headers, {})
+        exc_mock.assert_called_once_with(
+            'Cannot load the Mantis issue headers, every linked issue will '
+            'be fetched')
+
+    @mock.patch('SOAPpy.WSDL.Proxy', MantisMock)
+    def test_load_issue_headers_few_hosts(self):
+        checker = SecurityUpdatesChecker(self.config)
+        checker.issue_headers_page_size = 2
+        for issue_id in range(1, 6):
+            checker.db.add('host%d' % issue_id, issue_id)
+
+        checker.load_issue_headers([{'host_name': 'host1'},
+                                    {'host_name': 'host2'}])
+
+        self.assertEquals(checker.issue_headers, {})
+        self.assertFalse(checker.mantis.mc_project_get_issue_headers.called)
+
+    @mock.patch('SOAPpy.WSDL.Proxy', MantisMock)
+    def test_load_issue_headers_max_pages(self):
+        checker = SecurityUpdatesChecker(self.config)
+        checker.issue_headers_page_size = 2
+        for issue_id in range(1, 6):
+            checker.db.add('host%d' % issue_id, issue_id)
+        pages = ([dict(self.header, id=page * 2 + offset)
+                  for offset in (1, 2)] for page in range(1000))
+        checker.mantis.mc_project_get_issue_headers.side_effect = \
+            lambda *args: next(pages)
+
+        checker.load_issue_headers([{'host_name': 'host%d' % issue_id,
+                                     'host_notes': ''}
+                                    for issue_id in (1, 2, 3)])
+
+        self.assertEquals(sorted(checker.issue_headers), [1, 2, 3, 4, 5, 6])
+        self.assertEquals(
+            3, checker.mantis.mc_project_get_issue_headers.call_count)
+
+
+class ReconcileTest(CheckerTestCase):
+    def header(self, issue_id, hostname, status=10, category='General'):
+        return {
+            'id': issue_id,
+            'category': category,
+            'status': status,
+            'summary': 'Security updates available for host %s : '
+                       'python-django' % hostname,
+        }
+
+    @mock.patch('SOAPpy.WSDL.Proxy', MantisMock)
+    def test_reconcile(self):
+        checker = SecurityUpdatesChecker(self.config)
+        checker._nagios_all = mock.Mock(return_value=[
+            {'host_name': 'host1', 'plugin_output': 'OK', 'host_notes': ''},
+            {'host_name': 'host2', 'plugin_output': 'OK',
+             'host_notes': 'mantis_project_id: 3'},
+            {'host_name': 'host4', 'plugin_output': 'OK', 'host_notes': ''},
+        ])
+        checker.db.update_links([], [
+            ('host1', 10), ('host1', 11), ('host2', 20), ('host3', 30),
+            ('host1', 40), ('host2', 70),
+        ])
+        checker.db.set_notified(10, 0, ['python-django'])
+        checker.db.set_notified(20, 0, ['python-django'])
+        headers = {
+            1: [
+                self.header(10, 'host1'),
+                self.header(11, 'host1'),
+                self.header(30, 'host3'),
+                self.header(50, 'host4'),
+                dict(self.header(51, 'host4'), summary='Something else'),
+                self.header(52, 'host4', status=80),
+                self.header(60, 'host4', category='Other'),
+            ],
+            3: [self.header(20, 'host2', status=80)],
+        }
+        checker.mantis.mc_project_get_issue_headers.side_effect = \
+            lambda user, password, project_id, page, size: \
+            headers[project_id]
+        checker.mantis.mc_issue_exists.side_effect = \
+            lambda user, password, issue_id: issue_id == 70
+        checker.mantis.mc_issue_get.return_value = {
+            'id': 70,
+            'status': {'id': 90},
+            'summary': 'Security updates available for host host2 : vim',
+        }
+
+        with mock.patch('logging.info'):
+            report = checker.reconcile()
+
+        self.assertEquals(report, {
+            'deleted': [('host1', 40)],
+            'resolved': [('host2', 20), ('host2', 70)],
+            'decommissioned': [('host3', 30)],
+            'duplicate': [('host1', 11)],
+            'relinked': [('host4', 50)],
+        })
+        self.assertEquals(sorted(link[1:] for link in checker.db.links()),
+                          [('host1', 10), ('host4', 50)])
+        self.assertEquals(checker.db.get_notified(10),
+                          (0, set(['python-django'])))
+        self.assertEquals(checker.db.get_notified(20), (None, None))
+        checker.mantis.mc_issue_get.assert_called_once_with(
+            'mantis_login', 'mantis_password', 70)
+
+    @mock.patch('SOAPpy.WSDL.Proxy', MantisMock)
+    def test_reconcile_dry_run(self):
+        checker = SecurityUpdatesChecker(self.config)
+        checker._nagios_all = mock.Mock(return_value=[])
+        checker.db.add('host1', 10)
+        checker.mantis.mc_project_get_issue_headers.return_value = [
+            self.header(10, 'host1')]
+
+        with mock.patch('logging.info'):
+            report = checker.reconcile(dry_run=True, force=True)
+
+        self.assertEquals(report['decommissioned'], [('host1', 10)])
+        self.assertEquals(checker.db.links(), [(1, 'host1', 10)])
+
+    @mock.patch('SOAPpy.WSDL.Proxy', MantisMock)
+    def test_reconcile_identical_duplicates(self):
+        checker = SecurityUpdatesChecker(self.config)
+        checker._nagios_all = mock.Mock(return_value=[
+            {'host_name': 'host1', 'plugin_output': 'OK', 'host_notes': ''},
+        ])
+        checker.db.update_links([], [('host1', 10), ('host1', 10)])
+        checker.db.set_notified(10, 0, ['python-django'])
+        checker.mantis.mc_project_get_issue_headers.return_value = [
+            self.header(10, 'host1')]
+
+        with mock.patch('logging.info'):
+            report = checker.reconcile()
+
+        self.assertEquals(report['duplicate'], [('host1', 10)])
+        self.assertEquals(checker.db.links(), [(1, 'host1', 10)])
+        self.assertEquals(checker.db.get_notified(10),
+                          (0, set(['python-django'])))
+
+    @mock.patch('SOAPpy.WSDL.Proxy', MantisMock)
+    def test_reconcile_nagios_empty(self):
+        checker = SecurityUpdatesChecker(self.config)
+        checker._nagios_all = mock.Mock(return_value=[])
+        checker.db.update_links([], [('host1', 10), ('host2', 11)])
+        checker.mantis.mc_project_get_issue_headers.return_value = [
+            self.header(10, 'host1'), self.header(11, 'host2')]
+
+        with mock.patch('logging.info'),\
+                mock.patch('logging.error') as error_mock:
+            report = checker.reconcile()
+
+        self.assertEquals(report['decommissioned'], [])
+        self.assertEquals(len(checker.db.links()), 2)
+        error_mock.assert_called_once_with(
+            '%d of the %d links are for hosts missing from Nagios, keeping '
+            'them (use force to unlink them)', 2, 2)
+
+        with mock.patch('logging.info'):
+            report = checker.reconcile(force=True)
+
+        self.assertEquals(len(report['decommissioned']), 2)
+        self.assertEquals(checker.db.links(), [])
+
+    @mock.patch('SOAPpy.WSDL.Proxy', MantisMock)
+    def test_mantis_category_issues_pages(self):
+        checker = SecurityUpdatesChecker(self.config)
+        checker.issue_headers_page_size = 2
+        pages = [
+            [self.header(1, 'a'), self.header(2, 'b')],
+            [self.header(4, 'd', category='Other'), self.header(3, 'c')],
+            [self.header(4, 'd', category='Other'), self.header(3, 'c')],
+            [self.header(5, 'e'), self.header(6, 'f')],
+            [self.header(7, 'g')],
+        ]
+        checker.mantis.mc_project_get_issue_headers.side_effect = pages
+
+        issues = checker.mantis_category_issues([1, 2])
+
+        self.assertEquals(sorted(issues), [1, 2, 3, 5, 6, 7])
+        checker.mantis.mc_project_get_issue_headers.assert_any_call(
+            'mantis_login', 'mantis_password', 2, 2, 2)
+
+
+class MantisCallTest(CheckerTestCase):
+    def setUp(self):
+        super(MantisCallTest, self).setUp()
+        self.config.mantis_timeout = None
+        self.config.mantis_retries = 2
+        self.config.mantis_circuit_threshold = 3
+
+    @mock.patch('SOAPpy.WSDL.Proxy', MantisMock)
+    def test_retry_transient_error(self):
+        checker = SecurityUpdatesChecker(self.config)
+        checker.mantis.mc_issue_get.side_effect = [socket.timeout, {'id': 42}]
+
+        with mock.patch('time.sleep') as sleep_mock,\
+                mock.patch('logging.warning'):
+            issue = checker.mantis_call('mc_issue_get', 42)
+
+        self.assertEquals(issue, {'id': 42})
+        self.assertEquals(1, sleep_mock.call_count)
+        self.assertEquals(2, checker.mantis.mc_issue_get.call_count)
+        self.assertEquals(0, checker.mantis_failures)
+
+    @mock.patch('SOAPpy.WSDL.Proxy', MantisMock)
+    def test_retry_exhausted(self):
+        checker = SecurityUpdatesChecker(self.config)
+        checker.mantis.mc_issue_get.side_effect = faultType('Server', 'Down')
+
+        with mock.patch('time.sleep') as sleep_mock,\
+                mock.patch('logging.warning'),\
+                self.assertRaises(faultType):
+            checker.mantis_call('mc_issue_get', 42)
+
+        self.assertEquals(2, sleep_mock.call_count)
+        self.assertEquals(3, checker.mantis.mc_issue_get.call_count)
+
+    @mock.patch('SOAPpy.WSDL.Proxy', MantisMock)
+    def test_no_retry_add(self):
+        checker = SecurityUpdatesChecker(self.config)
+        checker.mantis.mc_issue_add.side_effect = socket.timeout
+
+        with mock.patch('time.sleep') as sleep_mock,\
+                self.assertRaises(socket.timeout):
+            checker.mantis_call('mc_issue_add', {'summary': 'summary'})
+
+        self.assertFalse(sleep_mock.called)
+        self.assertEquals(1, checker.mantis.mc_issue_add.call_count)
+        self.assertEquals(1, checker.mantis_failures)
+
+    @mock.patch('SOAPpy.WSDL.Proxy', MantisMock)
+    def test_no_retry_client_fault(self):
+        checker = SecurityUpdatesChecker(self.config)
+        checker.mantis_failures = 2
+        checker.mantis.mc_issue_get.side_effect = faultType(
+            'SOAP-ENV:Client', 'Issue #42 not found')
+
+        with mock.patch('time.sleep') as sleep_mock,\
+                self.assertRaises(faultType):
+            checker.mantis_call('mc_issue_get', 42)
+
+        self.assertFalse(sleep_mock.called)
+        self.assertEquals(0, checker.mantis_failures)
+
+    @mock.patch('SOAPpy.WSDL.Proxy', MantisMock)
+    def test_circuit_breaker(self):
+        checker = SecurityUpdatesChecker(self.config)
+        checker.mantis.mc_issue_get.side_effect = socket.error
+
+        with mock.patch('time.sleep'), mock.patch('logging.warning'),\
+                self.assertRaises(socket.error):
+            checker.mantis_call('mc_issue_get', 42)
+        self.assertTrue(checker.mantis_circuit_open)
+
+        with self.assertRaises(MantisUnavailable):
+            checker.mantis_call('mc_issue_get', 43)
+        self.assertEquals(3, checker.mantis.mc_issue_get.call_count)
+
+    @mock.patch('SOAPpy.WSDL.Proxy', MantisMock)
+    def test_retry_http_error(self):
+        checker = SecurityUpdatesChecker(self.config)
+        checker.mantis.mc_issue_get.side_effect = [
+            HTTPError(503, 'Service Unavailable'),
+            httplib.BadStatusLine(''),
+            {'id': 42},
+        ]
+
+        with mock.patch('time.sleep') as sleep_mock,\
+                mock.patch('logging.warning'):
+            issue = checker.mantis_call('mc_issue_get', 42)
+
+        self.assertEquals(issue, {'id': 42})
+        self.assertEquals(2, sleep_mock.call_count)
+        self.assertEquals(0, checker.mantis_failures)
+
+    @mock.patch('SOAPpy.WSDL.Proxy', MantisMock)
+    def test_check_lines_http_error(self):
+        checker = SecurityUpdatesChecker(self.config)
+        checker.mantis.mc_issue_get.side_effect = HTTPError(
+            503, 'Service Unavailable')
+
+        def check(line):
+            checker.mantis_call('mc_issue_get', 42)
+
+        with mock.patch('time.sleep'), mock.patch('logging.warning'),\
+                mock.patch('logging.exception') as exc_mock:
+            checker._check_lines([{'host_name': 'a'}, {'host_name': 'b'}],
+                                 check)
+
+        self.assertEquals(3, checker.mantis_failures)
+        self.assertEquals(2, checker.failures)
+        self.assertEquals(3, checker.mantis.mc_issue_get.call_count)
+        exc_mock.assert_called_with(
+            'Mantis is unavailable, skipping the remaining hosts')
+
+    @mock.patch('SOAPpy.WSDL.Proxy', MantisMock)
+    def test_no_retry_http_client_error(self):
+        checker = SecurityUpdatesChecker(self.config)
+        checker.mantis.mc_issue_get.side_effect = HTTPError(
+            404, 'Not Found')
+
+        with mock.patch('time.sleep') as sleep_mock,\
+                self.assertRaises(HTTPError):
+            checker.mantis_call('mc_issue_get', 42)
+
+        self.assertFalse(sleep_mock.called)
+        self.assertEquals(0, checker.mantis_failures)
+
+    def test_empty_response_is_transient(self):
+        checker = SecurityUpdatesChecker(self.config)
+
+        self.assertTrue(checker.is_transient_error(
+            HTTPError(200, 'Empty response from server')))
+
+    def test_timeout(self):
+        self.config.mantis_timeout = 12.5
+        checker = SecurityUpdatesChecker(self.config)
+
+        with mock.patch('SOAPpy.WSDL.Proxy') as proxy_mock:
+            checker.mantis
+
+        proxy_mock.assert_called_once_with(self.config.mantis_wsdl,
+                                           timeout=12.5)
+
+    def test_check_lines_circuit_open(self):
+        checker = SecurityUpdatesChecker(self.config)
+        check = mock.Mock(side_effect=MantisUnavailable)
+
+        with mock.patch('logging.exception') as exc_mock:
+            checker._check_lines([{'host_name': 'a'}, {'host_name': 'b'}],
+                                 check)
+
+        self.assertEquals(1, check.call_count)
+        exc_mock.assert_called_once_with(
+            'Mantis is unavailable, skipping the remaining hosts')
+
+    def test_config_defaults(self):
+        config = Config('nagios2mantis_security.ini')
+        config.remove_option('Mantis', 'timeout')
+
+        self.assertEquals('x', config.get_default('Mantis', 'timeout', 'x'))
+
+
+class HostStatusTest(unittest.TestCase):
+    def setUp(self):
+        self.row = {
+            'host_name': 'localhost',
+            'plugin_output': 'Packages: python-django python-soappy',
+            'host_notes': '',
+        }
+
+    def test_packages(self):
+        status = HostStatus.from_row(self.row)
+
+        self.assertEquals(status['packages'], 'python-django python-soappy')
+        self.assertEquals(status, self.row)
+        self.assertNotIn('all_packages', status)
+        with self.assertRaises(KeyError):
+            status['all_packages']
+
+        status['all_packages'] = 'python-django'
+        status['all_packages'] += ' python-soappy'
+        self.assertEquals(status.get('all_packages'),
+                          'python-django python-soappy')
+
+    def test_set_packages(self):
+        status = HostStatus.from_row(self.row)
+        status['packages'] = 'python-django'
+
+        self.assertEquals(status['packages'], 'python-django')
+        self.assertEquals(status, dict(self.row, packages='python-django'))
+
+    def test_unparseable_packages(self):
+        status = HostStatus.from_row(dict(
+            self.row, plugin_output='Service check timed out'))
+
+        self.assertIsNone(status['packages'])
+
+    def test_from_rows(self):
+        rows = [self.row, {'host_name': 'host2', 'plugin_output': 'OK'}]
+
+        statuses = HostStatus.from_rows(rows)
+
+        self.assertIs(statuses, rows)
+        self.assertIsInstance(rows[0], HostStatus)
+        self.assertEquals(rows[1], {'host_name': 'host2',
+                                    'plugin_output': 'OK',
+                                    'host_notes': ''})
+
+    def test_from_row(self):
+        self.row['all_packages'] = 'python-django'
+        status = HostStatus.from_row(self.row)
+
+        self.assertIs(status, HostStatus.from_row(status))
+        self.assertEquals(status, self.row)
+        self.assertNotEquals(status, {'host_name': 'localhost'})
+        self.assertNotEquals(status, 'localhost')
+
+    def test_unknown_key(self):
+        status = HostStatus.from_row(self.row)
+
+        with self.assertRaises(KeyError):
+            status['unknown']
+        with self.assertRaises(KeyError):
+            status['unknown'] = 'value'
+        self.assertIsNone(status.get('unknown'))
+        with self.assertRaises(AttributeError):
+            status.unknown = 'value'
+
+    def test_templates(self):
+        status = HostStatus.from_row(self.row)
+        status['all_packages'] = status['packages']
+
+        self.assertEquals(
+            'Security updates available for host %(host_name)s : '
+            '%(all_packages)s' % status,
+            'Security updates available for host localhost : '
+            'python-django python-soappy'
+        )
+        self.assertEquals(repr(status), repr(dict(status.items())))
+
+
+class SoapProxyMock(MantisMock):
+    def __init__(self, url, timeout=None):
+        super(SoapProxyMock, self).__init__(url, timeout)
+        self.soapproxy = mock.Mock()
+
+
+class HostTracerTest(CheckerTestCase):
+    def test_disabled(self):
+        tracer = HostTracer()
+        tracer.start('localhost')
+        tracer.add('soap_calls', 1)
+        tracer.set('action', 'close')
+        tracer.stop()
+
+        self.assertEquals(tracer.traces, [])
+
+    def test_slowest(self):
+        tracer = HostTracer(enabled=True)
+        with mock.patch('time.time', side_effect=[0, 1, 10, 15, 20, 22]):
+            for hostname in ('host1', 'host2', 'host3'):
+                tracer.start(hostname)
+                tracer.stop()
+
+        self.assertEquals(
+            [trace['host_name'] for trace in tracer.slowest(2)],
+            ['host2', 'host3']
+        )
+
+    def test_write(self):
+        tracer = HostTracer(enabled=True)
+        tracer.start('localhost')
+        tracer.add('bytes', 12)
+        tracer.stop()
+
+        with mock.patch('__builtin__.open', mock.mock_open()) as open_mock:
+            tracer.write('profile.trace.jsonl')
+
+        open_mock.assert_called_once_with('profile.trace.jsonl', 'w')
+        data = json.loads(open_mock().write.call_args[0][0])
+        self.assertEquals(data['host_name'], 'localhost')
+        self.assertEquals(data['bytes'], 12)
+
+    def test_counting_transport(self):
+        tracer = HostTracer(enabled=True)
+        transport = mock.Mock()
+        transport.call.return_value = ('<response/>', 'ns')
+        transport.http_proxy = None
+        counting = CountingTransport(transport, tracer)
+        tracer.start('localhost')
+
+        response = counting.call('addr', '<request/>', 'ns', soapaction='a')
+
+        self.assertEquals(response, ('<response/>', 'ns'))
+        transport.call.assert_called_once_with('addr', '<request/>', 'ns',
+                                               soapaction='a')
+        self.assertEquals(tracer.current['bytes'], 21)
+        self.assertIsNone(counting.http_proxy)
+
+    @mock.patch('SOAPpy.WSDL.Proxy', SoapProxyMock)
+    def test_check_lines(self):
+        checker = SecurityUpdatesChecker(self.config)
+        checker.tracer.enabled = True
+        self.assertIsInstance(checker.mantis.soapproxy.transport,
+                              CountingTransport)
+        checker.mantis.mc_issue_add.return_value = 42
+        lines = [
+            {'host_name': 'localhost', 'plugin_output': 'Packages: vim',
+             'host_notes': ''},
+            {'host_name': 'host2', 'plugin_output': 'Packages: vim',
+             'host_notes': ''},
+        ]
+        checker.db.add('host2', 12)
+        checker.mantis.mc_issue_get.side_effect = sqlite3.Error
+
+        with mock.patch('logging.exception'):
+            checker._check_lines(lines, checker.check_error)
+
+        traces = checker.tracer.traces
+        self.assertEquals([trace['action'] for trace in traces],
+                          ['add_issue', 'error'])
+        self.assertEquals([trace['soap_calls'] for trace in traces], [1, 1])
+
+
+class FleetPackagesTest(CheckerTestCase):
+    def test_diffs(self):
+        fleet = FleetPackages(
+            {
+                'host1': 'python-django python-soappy',
+                'host2': 'python-django python-soappy',
+                'host3': 'python-django',
+                'host4': 'vim',
+            },
+            {
+                'host1': frozenset(['python-django', 'python-mock']),
+                'host2': frozenset(['python-django', 'python-mock']),
+                'host3': frozenset(['python-django']),
+            }
+        )
+
+        self.assertEquals(fleet.diffs['host1'], PackageDiff(
+            new=('python-soappy',),
+            removed=('python-mock',),
+            unchanged=('python-django',),
+        ))
+        self.assertIs(fleet.diffs['host1'], fleet.diffs['host2'])
+        self.assertEquals(fleet.diffs['host4'].new, ('vim',))
+        self.assertFalse(fleet.up_to_date('host1'))
+        self.assertTrue(fleet.up_to_date('host3'))
+        self.assertFalse(fleet.up_to_date('host4'))
+        self.assertEquals(fleet.host_counts, {
+            'python-django': 3,
+            'python-soappy': 2,
+            'vim': 1,
+        })
+
+    def test_check_errors_up_to_date(self):
+        checker = SecurityUpdatesChecker(self.config)
+        line1 = {
+            'host_name': 'localhost',
+            'plugin_output': 'Packages: python-django',
+            'host_notes': '',
+        }
+        line2 = {
+            'host_name': 'host2',
+            'plugin_output': 'Packages: python-django python-soappy',
+            'host_notes': '',
+        }
+        checker.db.add('localhost', 42)
+        checker.db.set_notified(42, 0, ['python-django'])
+        checker.db.add('host2', 43)
+        checker.db.set_notified(43, 0, ['python-django'])
+        checker.issue_headers = {
+            42: {'id': 42, 'status': 10},
+            43: {'id': 43, 'status': 10},
+        }
+        checker._nagios_errors = mock.Mock(return_value=[line1, line2])
+        checker.check_error = mock.Mock()
+
+        with mock.patch('logging.info') as info_mock:
+            checker.check_errors()
+
+        checker.check_error.assert_called_once_with(line2)
+        info_mock.assert_called_once_with(
+            '%d hosts have no new package to notify', 1)
+
+    def test_check_errors_up_to_date_resolved(self):
+        checker = SecurityUpdatesChecker(self.config)
+        line1 = {
+            'host_name': 'localhost',
+            'plugin_output': 'Packages: python-django',
+            'host_notes': '',
+        }
+        line2 = {
+            'host_name': 'host2',
+            'plugin_output': 'Packages: python-django',
+            'host_notes': '',
+        }
+        checker.db.add('localhost', 42)
+        checker.db.set_notified(42, 0, ['python-django'])
+        checker.db.add('host2', 43)
+        checker.db.set_notified(43, 0, ['python-django'])
+        # Resolved by hand, and not listed in the headers
+        checker.issue_headers = {42: {'id': 42, 'status': 80}}
+        checker._nagios_errors = mock.Mock(return_value=[line1, line2])
+        checker.check_error = mock.Mock()
+
+        checker.check_errors()
+
+        self.assertEquals(2, checker.check_error.call_count)
+        checker.check_error.assert_any_call(line1)
+        checker.check_error.assert_any_call(line2)
+
+    @mock.patch('SOAPpy.WSDL.Proxy', MantisMock)
+    def test_check_errors_resolved_new_issue(self):
+        checker = SecurityUpdatesChecker(self.config)
+        checker.db.add('localhost', 42)
+        checker.db.set_notified(42, 0, ['python-django'])
+        checker.issue_headers = {42: {
+            'id': 42,
+            'status': 80,
+            'notes_count': 0,
+            'last_updated': '2013-10-01T12:00:00',
+        }}
+        checker._nagios_errors = mock.Mock(return_value=[{
+            'host_name': 'localhost',
+            'plugin_output': 'Packages: python-django',
+            'host_notes': '',
+        }])
+        checker.mantis.mc_issue_get.return_value = {
+            'id': 42,
+            'status': {'id': 80},
+            'category': 'General',
+            'project': {'id': 1},
+            'summary': 'Security updates available for host localhost : '
+                       'python-django',
+            'description': 'python-django',
+            'notes': [],
+        }
+        checker.mantis.mc_issue_add.return_value = 43
+
+        checker.check_errors()
+
+        self.assertEquals(1, checker.mantis.mc_issue_add.call_count)
+        self.assertEquals(43, checker.db.get_issue_id('localhost'))
+        self.assertEquals(0, checker.failures)
+
+    def test_report(self):
+        checker = SecurityUpdatesChecker(self.config)
+        checker._nagios_errors = mock.Mock(return_value=[
+            {'host_name': 'localhost', 'plugin_output': 'Packages: vim',
+             'host_notes': ''},
+            {'host_name': 'host2', 'plugin_output': 'Packages: vim bash',
+             'host_notes': ''},
+        ])
+
+        self.assertEquals(checker.report().most_common(),
+                          [('vim', 2), ('bash', 1)])
+
+    def test_check_errors_unparseable(self):
+        checker = SecurityUpdatesChecker(self.config)
+        line1 = {
+            'host_name': 'localhost',
+            'plugin_output': 'Service check timed out',
+            'host_notes': '',
+        }
+        line2 = {
+            'host_name': 'host2',
+            'plugin_output': 'Packages: python-django',
+            'host_notes': '',
+        }
+        checker._nagios_errors = mock.Mock(return_value=[line1, line2])
+        checker.check_error = mock.Mock()
+
+        with mock.patch('logging.warning') as warning_mock:
+            checker.check_errors()
+            self.assertEquals(checker.report(), {'python-django': 1})
+
+        checker.check_error.assert_called_once_with(line2)
+        warning_mock.assert_called_with(
+            'Cannot parse the packages of %s: %s', 'localhost',
+            'Service check timed out')
+
 
 class DbLinkTest(unittest.TestCase):
     def test_add_twice(self):
@@ -524,5 +1523,23 @@ class DbLinkTest(unittest.TestCase):
         rows = cursor.fetchall()
         self.assertEquals(rows, [(u'localhost', 42)])
 
+    def test_state(self):
+        db = DbLink(':memory:')
+        self.assertIsNone(db.get_state('key'))
+
+        db.set_state('key', 'value')
+        db.set_state('key', 'other value')
+
+        self.assertEquals(db.get_state('key'), 'other value')
+
+    def test_notified_by_host(self):
+        db = DbLink(':memory:')
+        db.add('localhost', 42)
+        db.set_notified(42, 3, ['vim', 'bash'])
+        db.set_notified(43, 3, ['python-django'])
+
+        self.assertEquals(db.notified_by_host(),
+                          {'localhost': frozenset(['vim', 'bash'])})
+
 if __name__ == '__main__':
     unittest.main()